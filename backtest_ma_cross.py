@@ -1,153 +1,350 @@
+import os
+import tempfile
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
 import pandas as pd
 
+try:
+    from numba import njit, prange
+except ImportError:  # Pythonista など numba が入っていない環境ではそのまま Python で動かす
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+
+        def decorator(func):
+            return func
+
+        return decorator
+
+try:
+    import polars as pl
+except ImportError:  # polars が無ければ pandas だけで読み込む
+    pl = None
+
+try:
+    import pyarrow  # noqa: F401  pd.read_csv(engine="pyarrow") 用
+except ImportError:
+    pyarrow = None
+
 # ================== 設定 ==================
 
 CSV_PATH = "usdjpy_yahoo_30d_5m.csv"
 
-DEFAULT_PARAMS = {
-    "short_window": 20,         # 短期MA
-    "long_window": 60,          # 長期MA
-    "initial_capital": 10_000,  # 初期資金
-    "fee_rate": 0.00002,        # 手数料率 (0.002% = 0.00002)
-    "trade_size": 1,            # 1トレードあたり枚数
-}
+
+class Params(NamedTuple):
+    """バックテストのパラメータ。GA などで何度も読むので dict ではなく数値だけのタプルにしている。"""
+    short_window: int       # 短期MA
+    long_window: int        # 長期MA
+    initial_capital: float  # 初期資金
+    fee_rate: float         # 手数料率
+    trade_size: float       # 1トレードあたり枚数
+
+
+DEFAULT_PARAMS = Params(
+    short_window=20,         # 短期MA
+    long_window=60,          # 長期MA
+    initial_capital=10_000,  # 初期資金
+    fee_rate=0.00002,        # 手数料率 (0.002% = 0.00002)
+    trade_size=1,            # 1トレードあたり枚数
+)
 
 
 # ================== データ読み込み ==================
 
-def load_price_data(path: str) -> pd.DataFrame:
-    """CSV からデータを読み込み、Datetime を整えて返す。"""
+PRICE_COLUMNS = ["Datetime", "Close", "High", "Low", "Open", "Volume"]
+
+
+def _load_price_data_polars(path: str) -> pd.DataFrame:
+    """polars のマルチスレッドな CSV パーサで読み込み、pandas の DataFrame に詰め直す。"""
+    df = pl.read_csv(
+        path,
+        skip_rows=2,  # 先頭2行のメタ情報を飛ばす
+        has_header=False,
+        new_columns=PRICE_COLUMNS,
+        # 型推論に任せず pandas で読んだときと同じ float64 に揃える。Yahoo の欠損は "null" で入ってくる
+        schema_overrides={col: pl.Float64 for col in PRICE_COLUMNS[1:]},
+        null_values=["null", ""],
+    )
+    df = df.with_columns(df["Datetime"].str.to_datetime(strict=False))
+    df = df.drop_nulls("Datetime").sort("Datetime")
+
+    datetimes = pd.Series(df["Datetime"].to_numpy())
+    time_zone = df.schema["Datetime"].time_zone
+    if time_zone is not None:
+        datetimes = datetimes.dt.tz_localize(time_zone)
+
+    out = pd.DataFrame({col: df[col].to_numpy() for col in PRICE_COLUMNS[1:]})
+    out.insert(0, "Datetime", datetimes)
+    return out
+
+
+def _load_price_data_pandas(path: str) -> pd.DataFrame:
+    """pandas で CSV を読み込む。"""
+    read_options = {}
+    if pyarrow is not None:
+        # pyarrow のパーサの方が速い。列の型は C エンジンで読んだときと揃える
+        # (Datetime も文字列のまま受け取らないと、日付だけの行が date 型で先に解釈されてしまう)
+        read_options = {
+            "engine": "pyarrow",
+            "dtype": {"Datetime": str, **{col: "float64" for col in PRICE_COLUMNS[1:]}},
+        }
+
     df = pd.read_csv(
         path,
         skiprows=2,  # 先頭2行のメタ情報を飛ばす
-        names=["Datetime", "Close", "High", "Low", "Open", "Volume"],
+        names=PRICE_COLUMNS,
+        **read_options,
     )
-    df["Datetime"] = pd.to_datetime(df["Datetime"], errors="coerce")
+    # 書式を指定しないと 1 行ずつ dateutil で解析されて遅いので ISO8601 と明示する
+    df["Datetime"] = pd.to_datetime(df["Datetime"], errors="coerce", format="ISO8601")
     df = df.dropna(subset=["Datetime"])
     df = df.sort_values("Datetime").reset_index(drop=True)
     return df
 
 
-# ================== バックテスト本体 ==================
-
-def calculate_max_drawdown(equity_curve):
-    max_peak = 0
-    max_dd = 0
-    for eq in equity_curve:
-        if eq > max_peak:
-            max_peak = eq
-        if max_peak > 0:
-            dd = (eq - max_peak) / max_peak
-            if dd < max_dd:
-                max_dd = dd
-    return max_dd
-
-
-def _run_backtest(df: pd.DataFrame, params: dict):
+def load_price_data(path: str) -> pd.DataFrame:
     """
-    シンプルな移動平均クロス戦略のバックテスト。
-    ゴールデンクロスで買い、デッドクロスで全決済。
+    CSV からデータを読み込み、Datetime を整えて返す。
+    pyarrow があれば読み込んだ結果を CSV の隣に .parquet で保存しておき、
+    CSV が更新されていない間は次回からそちらを読む (CSV の解析と日時の変換を飛ばせる)。
     """
-    df = df.copy()
-
-    short = params["short_window"]
-    long = params["long_window"]
-
-    # インジケーター
-    df["sma_short"] = df["Close"].rolling(window=short).mean()
-    df["sma_long"] = df["Close"].rolling(window=long).mean()
-
-    # シグナル & ポジション
-    df["signal"] = 0
-    df.loc[df["sma_short"] > df["sma_long"], "signal"] = 1
-    df["position"] = df["signal"].shift(1).fillna(0)
+    csv_path = Path(path)
+    cache_path = csv_path.with_suffix(".parquet")
+    if (
+        pyarrow is not None
+        and cache_path.exists()
+        and cache_path.stat().st_mtime >= csv_path.stat().st_mtime
+    ):
+        try:
+            return pd.read_parquet(cache_path)
+        except (OSError, ValueError):
+            pass  # 壊れたキャッシュは捨てて CSV から読み直す
+
+    if pl is not None:
+        df = _load_price_data_polars(path)
+    else:
+        df = _load_price_data_pandas(path)
+
+    if pyarrow is not None:
+        # 書き込み途中で止まっても壊れたキャッシュが残らないよう、一時ファイルから置き換える
+        # (同時に走る別プロセスと一時ファイルがぶつからないよう、名前はプロセスごとに変える)
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                dir=cache_path.parent, prefix=cache_path.name + ".",
+                suffix=".tmp", delete=False,
+            ) as tmp:
+                tmp_path = tmp.name
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, cache_path)
+        except (OSError, ValueError):
+            # 書き込めない場所なら毎回 CSV から読むだけ
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return df
 
-    # 取引イベント (+1: 新規買い, -1: 決済)
-    df["trade"] = df["position"].diff().fillna(df["position"])
 
-    capital = params["initial_capital"]
-    fee_rate = params["fee_rate"]
-    size = params["trade_size"]
+# ================== バックテスト本体 ==================
 
-    cash = capital
-    position = 0
-    last_price = None
+def calculate_max_drawdown(equity_curve):
+    """
+    時価評価の推移から最大ドローダウン (0 以下の比率) を求める。
+    バックテスト本体はループの中で同じ値を更新しているので使っておらず、外から曲線を渡して確かめる用に残している。
+    """
+    eq = np.asarray(equity_curve, dtype=np.float64)
+    if not len(eq):
+        return 0.0
+    peaks = np.maximum.accumulate(eq)
+    # ピークが 0 以下の間はドローダウンを数えない
+    dd = np.where(peaks > 0, (eq - peaks) / np.where(peaks > 0, peaks, 1), 0.0)
+    return min(float(dd.min()), 0.0)
 
-    equity_curve = []
-    raw_trades = []  # すべての約定(BUY/SELL)
 
-    for _, row in df.iterrows():
-        price = float(row["Close"])
-        trade = int(row["trade"])
+def sma(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    単純移動平均。累積和の差を取るので、窓の長さに関係なく 1 回のスキャンで済む。
+    先頭 window-1 本は rolling().mean() と同じく NaN になる。
+    欠損 (NaN / inf) があっても、rolling().mean() と同じくその値を窓に含むバーだけが NaN になる。
+    """
+    missing = ~np.isfinite(values)
+    has_missing = bool(missing.any())
+    if has_missing:
+        # 欠損を 0 として足し込み、あとで欠損を含む窓だけ NaN に戻す
+        values = np.where(missing, 0.0, values)
+
+    cs = np.empty(len(values) + 1)
+    cs[0] = 0.0
+    np.cumsum(values, out=cs[1:])
+    out = np.full(len(values), np.nan)
+    out[window - 1:] = (cs[window:] - cs[:-window]) / window
+
+    if has_missing:
+        n_missing = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(missing, out=n_missing[1:])
+        out[window - 1:][n_missing[window:] - n_missing[:-window] > 0] = np.nan
+    return out
+
+
+@njit(cache=True)
+def _cross_signal(sma_short: np.ndarray, sma_long: np.ndarray) -> np.ndarray:
+    """
+    SMA の配列からクロスを検出し、約定するバーに +1(買い) / -1(決済) を立てた配列を返す。
+    クロスが確定したバーの次のバーで約定させる。
+    """
+    # NaN との比較は False になるので、SMA が揃う前はノーポジ扱い
+    above = (sma_short > sma_long).astype(np.int8)
+    signal = np.zeros(above.shape[0], dtype=np.int8)
+    if above.shape[0] > 1:
+        signal[1] = above[0]
+        signal[2:] = above[1:-1] - above[:-2]
+    return signal
+
+
+@njit(cache=True)
+def _update_drawdown(equity, peak, max_dd):
+    """1 本分の時価評価でピークと最大ドローダウンを更新する (calculate_max_drawdown と同じ定義)。"""
+    if equity > peak:
+        peak = equity
+    elif peak > 0.0:
+        dd = (equity - peak) / peak
+        if dd < max_dd:
+            max_dd = dd
+    return peak, max_dd
+
+
+@njit(cache=True)
+def _simulate_njit(close, signal, fee_rate, size, initial_capital, record):
+    """
+    シグナル(+1: 新規買い, -1: 全決済)どおりに約定させる売買ロジック本体。
+    最終残高・最大ドローダウン・トレード回数・勝ちトレード数と、
+    ラウンドトリップごとのエントリー/エグジット位置・損益を返す。
+    record が False のときはトレード一覧の配列を作らず、集計値だけ計算する。
+    最後まで持っていたポジションは最終バーの終値で決済したことにする。
+    """
+    n = close.shape[0]
+
+    max_trades = n // 2 + 1 if record else 0
+    entry_idx = np.empty(max_trades, dtype=np.int64)
+    exit_idx = np.empty(max_trades, dtype=np.int64)
+    pnl = np.empty(max_trades)
+    n_trades = 0
+    wins = 0
+
+    cash = initial_capital
+    position = 0.0
+    entry_price = 0.0
+    entry_fee = 0.0
+
+    # 最大ドローダウンは時価評価と同じループで更新し、時価評価の推移は配列に残さない
+    peak = 0.0
+    max_dd = 0.0
+
+    if n == 0:
+        return cash, max_dd, n_trades, wins, entry_idx, exit_idx, pnl
+
+    # クロスが起きたバーだけ状態遷移させ、間のバーは時価評価だけする。
+    # 最終バーは強制決済があるので、シグナルが無くてもイベントとして扱う。
+    events = np.flatnonzero(signal[: n - 1])
+    prev = 0
+    for k in range(len(events) + 1):
+        i = events[k] if k < len(events) else n - 1
+
+        # ノーポジの間は残高が一定なので 1 回だけ評価すればよい
+        if position == 0.0:
+            if i > prev:
+                peak, max_dd = _update_drawdown(cash, peak, max_dd)
+        else:
+            for j in range(prev, i):
+                eq = cash + position * float(close[j])
+                peak, max_dd = _update_drawdown(eq, peak, max_dd)
+
+        # close の dtype によらず残高・損益は float64 で計算する
+        price = float(close[i])
 
         # 新規買い
-        if trade == 1 and position == 0:
+        if signal[i] == 1 and position == 0.0:
             cost = price * size
-            fee = cost * fee_rate
-            cash -= cost + fee
-            position += size
-            raw_trades.append(
-                {
-                    "Datetime": row["Datetime"],
-                    "Side": "BUY",
-                    "Price": price,
-                    "Size": size,
-                    "Fee": fee,
-                }
-            )
-
-        # 全決済
-        elif trade == -1 and position > 0:
+            entry_fee = cost * fee_rate
+            cash -= cost + entry_fee
+            position = size
+            entry_price = price
+            if record:
+                entry_idx[n_trades] = i
+
+        # 全決済 (最後まで持っていたら終値で決済したことにする)
+        if position > 0.0 and (signal[i] == -1 or i == n - 1):
             proceeds = price * position
             fee = proceeds * fee_rate
             cash += proceeds - fee
-            raw_trades.append(
-                {
-                    "Datetime": row["Datetime"],
-                    "Side": "SELL",
-                    "Price": price,
-                    "Size": position,
-                    "Fee": fee,
-                }
-            )
-            position = 0
-
-        last_price = price
-        equity_curve.append(cash + position * price)
-
-    # 最後まで持っていたら終値で決済したことにする
-    if last_price is not None and position > 0:
-        proceeds = last_price * position
-        fee = proceeds * fee_rate
-        cash += proceeds - fee
-        raw_trades.append(
-            {
-                "Datetime": df.iloc[-1]["Datetime"],
-                "Side": "SELL",
-                "Price": last_price,
-                "Size": position,
-                "Fee": fee,
-            }
+            trade_pnl = (price - entry_price) * position - (entry_fee + fee)
+            if trade_pnl > 0:
+                wins += 1
+            if record:
+                exit_idx[n_trades] = i
+                pnl[n_trades] = trade_pnl
+            n_trades += 1
+            position = 0.0
+
+        eq = cash + position * price
+        peak, max_dd = _update_drawdown(eq, peak, max_dd)
+        prev = i + 1
+
+    return (
+        cash,
+        max_dd,
+        n_trades,
+        wins,
+        entry_idx[:n_trades],
+        exit_idx[:n_trades],
+        pnl[:n_trades],
+    )
+
+
+@njit(cache=True, parallel=True)
+def _run_grid_njit(close, sma_table, short_rows, long_rows, fee_rate, size, initial_capital):
+    """
+    (sma_table[short_rows[k]], sma_table[long_rows[k]]) の組み合わせごとにバックテストし、スコアの配列を返す。
+    シグナルは組み合わせごとにループの中で作るので、組み合わせ × バーの配列は持たない。
+    """
+    n_combos = short_rows.shape[0]
+    scores = np.empty(n_combos)
+    for k in prange(n_combos):
+        signal = _cross_signal(sma_table[short_rows[k]], sma_table[long_rows[k]])
+        final_equity, max_dd, _, _, _, _, _ = _simulate_njit(
+            close, signal, fee_rate, size, initial_capital, False
         )
-        position = 0
-        equity_curve[-1] = cash
-
-    final_equity = cash
-    max_dd = calculate_max_drawdown(equity_curve)
-
-    # ラウンドトリップ単位で損益計算
-    round_trips = []
-    entry = None
-    for tr in raw_trades:
-        if tr["Side"] == "BUY":
-            entry = tr
-        elif tr["Side"] == "SELL" and entry is not None:
-            pnl = (tr["Price"] - entry["Price"]) * entry["Size"] - (entry["Fee"] + tr["Fee"])
-            round_trips.append(pnl)
-            entry = None
-
-    n_trades = len(round_trips)
-    wins = sum(1 for p in round_trips if p > 0)
+        scores[k] = final_equity * (1 - max_dd)
+    return scores
+
+
+def _run_backtest_arrays(
+    close: np.ndarray,
+    sma_short: np.ndarray,
+    sma_long: np.ndarray,
+    params: Params,
+    compute_trades: bool = True,
+):
+    """
+    計算済みの終値・SMA の配列を受け取ってバックテストする。
+    ラウンドトリップはバー位置 (entry_idx / exit_idx) と損益 (pnl) の配列で返す。
+    compute_trades=False のときはスコアなどの集計値だけ計算し、これらの配列は空になる。
+    """
+    # 取引イベント (+1: 新規買い, -1: 決済)
+    trades = _cross_signal(sma_short, sma_long)
+
+    final_equity, max_dd, n_trades, wins, entry_idx, exit_idx, pnl = _simulate_njit(
+        close,
+        trades,
+        float(params.fee_rate),
+        float(params.trade_size),
+        float(params.initial_capital),
+        compute_trades,
+    )
+
     win_rate = wins / n_trades if n_trades > 0 else 0.0
 
     # 評価スコア(とりあえず「最終残高 × (1-最大DD)」)
@@ -159,49 +356,109 @@ def _run_backtest(df: pd.DataFrame, params: dict):
         "n_trades": n_trades,
         "win_rate": win_rate,
         "score": score,
-        "raw_trades": raw_trades,
+        "entry_idx": entry_idx,
+        "exit_idx": exit_idx,
+        "pnl": pnl,
     }
 
 
+def _run_backtest(df: pd.DataFrame, params: Params, compute_trades: bool = True):
+    """
+    シンプルな移動平均クロス戦略のバックテスト。
+    ゴールデンクロスで買い、デッドクロスで全決済。
+    渡された DataFrame には列を足さず、配列だけで計算する。
+    スコアだけ欲しいときは compute_trades=False でトレード一覧を作らない。
+    """
+    short = params.short_window
+    long = params.long_window
+
+    close = df["Close"].to_numpy(np.float64)
+
+    # インジケーター
+    sma_short = sma(close, short)
+    sma_long = sma(close, long)
+
+    return _run_backtest_arrays(close, sma_short, sma_long, params, compute_trades)
+
+
+def _trades_frame(df: pd.DataFrame, result: dict, size) -> pd.DataFrame:
+    """
+    バー位置 (entry_idx / exit_idx) で持っているラウンドトリップを、CSV 出力用の DataFrame にする。
+    Timestamp を作るのは CSV に書き出すときのここだけにする。
+    """
+    entry_idx = result["entry_idx"]
+    exit_idx = result["exit_idx"]
+    close = df["Close"].to_numpy(np.float64)
+    datetimes = df["Datetime"].array
+    return pd.DataFrame(
+        {
+            "EntryTime": datetimes.take(entry_idx),
+            "EntryPrice": close[entry_idx],
+            "ExitTime": datetimes.take(exit_idx),
+            "ExitPrice": close[exit_idx],
+            "Size": size,
+            "PnL": result["pnl"],
+        }
+    )
+
+
 # ================== 外から呼ぶ用の関数 ==================
 
-def evaluate_params(df: pd.DataFrame, params: dict) -> float:
+def evaluate_params(df: pd.DataFrame, params: Params) -> float:
     """
     グリッドサーチや GA から呼ぶための関数。
-    DataFrame と params(dict) を受け取って「スコア」だけ返す。
+    DataFrame と Params を受け取って「スコア」だけ返す。
     """
-    result = _run_backtest(df, params)
+    result = _run_backtest(df, params, compute_trades=False)
     return result["score"]
 
 
-def run_and_save_trades(df: pd.DataFrame, params: dict, trades_path: str = "trades_latest.csv"):
+def evaluate_arrays(close: np.ndarray, sma_short: np.ndarray, sma_long: np.ndarray, params: Params) -> float:
+    """
+    evaluate_params の配列版。
+    終値と SMA を呼び出し側で計算済みのとき、それを渡してスコアだけ求める。
+    """
+    result = _run_backtest_arrays(close, sma_short, sma_long, params, compute_trades=False)
+    return result["score"]
+
+
+def evaluate_grid(close: np.ndarray, short_windows, long_windows, params: Params) -> np.ndarray:
+    """
+    短期 × 長期の全組み合わせをまとめてバックテストし、(短期, 長期) の 2 次元配列でスコアを返す。
+    短期 >= 長期 の組み合わせは計算せず NaN にする。
+    SMA は窓ごとに 1 回だけ計算して表にし、各組み合わせはその行を参照する。
+    numba があれば組み合わせごとのバックテストを複数コアで並列に回す。
+    """
+    short_windows = np.asarray(short_windows)
+    long_windows = np.asarray(long_windows)
+    n_short = len(short_windows)
+
+    windows, rows = np.unique(np.concatenate([short_windows, long_windows]), return_inverse=True)
+    sma_table = np.stack([sma(close, int(w)) for w in windows])
+
+    scores = np.full((n_short, len(long_windows)), np.nan)
+    short_idx, long_idx = np.nonzero(short_windows[:, None] < long_windows[None, :])
+    scores[short_idx, long_idx] = _run_grid_njit(
+        close,
+        sma_table,
+        rows[short_idx],
+        rows[n_short + long_idx],
+        float(params.fee_rate),
+        float(params.trade_size),
+        float(params.initial_capital),
+    )
+    return scores
+
+
+def run_and_save_trades(df: pd.DataFrame, params: Params, trades_path: str = "trades_latest.csv"):
     """
     1 回バックテストして結果を表示 + トレード一覧を CSV に保存。
     """
     result = _run_backtest(df, params)
 
-    # トレード一覧CSV用にラウンドトリップを作る
-    trades = []
-    entry = None
-    for tr in result["raw_trades"]:
-        if tr["Side"] == "BUY":
-            entry = tr
-        elif tr["Side"] == "SELL" and entry is not None:
-            pnl = (tr["Price"] - entry["Price"]) * entry["Size"] - (entry["Fee"] + tr["Fee"])
-            trades.append(
-                {
-                    "EntryTime": entry["Datetime"],
-                    "EntryPrice": entry["Price"],
-                    "ExitTime": tr["Datetime"],
-                    "ExitPrice": tr["Price"],
-                    "Size": entry["Size"],
-                    "PnL": pnl,
-                }
-            )
-            entry = None
-
-    if trades:
-        pd.DataFrame(trades).to_csv(trades_path, index=False, encoding="utf-8-sig")
+    if result["n_trades"] > 0:
+        trades = _trades_frame(df, result, params.trade_size)
+        trades.to_csv(trades_path, index=False, encoding="utf-8-sig")
         print(f"トレード一覧を保存しました: {trades_path}")
 
     print("===== バックテスト結果 =====")
@@ -1,6 +1,8 @@
+import numpy as np
+
 from backtest_ma_cross import (
     load_price_data,
-    evaluate_params,
+    evaluate_grid,
     DEFAULT_PARAMS,
     CSV_PATH,
 )
@@ -9,27 +11,30 @@ from backtest_ma_cross import (
 def main():
     df = load_price_data(CSV_PATH)
 
+    # ざっくりサーチの例:
+    # 短期 5〜30 / 長期 40〜120 を試す
+    shorts = range(5, 31, 5)      # 5,10,15,20,25,30
+    longs = range(40, 121, 10)    # 40,50,...,120
+
+    # 全組み合わせを 1 回でまとめて評価する (短期 >= 長期 は NaN で返ってくる)
+    close = df["Close"].to_numpy(np.float64)
+    scores = evaluate_grid(close, shorts, longs, DEFAULT_PARAMS)
+
     best_params = None
     best_score = None
 
-    # ざっくりサーチの例:
-    # 短期 5〜30 / 長期 40〜120 を試す
-    for short in range(5, 31, 5):      # 5,10,15,20,25,30
-        for long in range(40, 121, 10):  # 40,50,...,120
+    for i, short in enumerate(shorts):
+        for j, long in enumerate(longs):
             if short >= long:
                 continue  # 短期 >= 長期 はスキップ
 
-            params = dict(DEFAULT_PARAMS)
-            params["short_window"] = short
-            params["long_window"] = long
-
-            score = evaluate_params(df, params)
+            score = scores[i, j]
 
             print(f"short={short:2d}, long={long:3d} -> score={score:.2f}")
 
             if (best_score is None) or (score > best_score):
                 best_score = score
-                best_params = params
+                best_params = DEFAULT_PARAMS._replace(short_window=short, long_window=long)
 
     print("\n===== ベストパラメータ =====")
     if best_params is None: